@@ -1,158 +1,523 @@
 import streamlit as st
 import os
+import asyncio
+import hashlib
+import json
+import re
 import zipfile
 import shutil
-import fitz  # PyMuPDF
-from PIL import Image
-from io import BytesIO
-import base64
+import tempfile
+import threading
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core.exceptions import ResourceExhausted
 from dotenv import load_dotenv
+from pdf_render import page_count, render_page
 
-# Load .env and configure Gemini
+# Load .env for GEMINI_API_KEY
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))  # or use a hardcoded key
-
-# At the top — before any state use
-if "cleanup_trigger" not in st.session_state:
-    st.session_state["cleanup_trigger"] = False
-
-# Sidebar for custom system prompt
-st.sidebar.header("System Prompt")
-custom_prompt = st.sidebar.text_area(
-    "Override Default",
-    value="""Extract all readable text from this image. Return only plain text and formatting if necessary. EXCLUSIVELY use latex tags for both markdown and mathematical notations and equations For mathematical expressions: 
-    1. For inline equations, use single dollar signs: $ ... $ 2. For display equations, use double dollar signs: $$ ... $$ 
-    3. For units, use regular text, not \\text command: atm, K, Â°C 
-    4. For variables, use single letters without \\text: P, T, V 5. Format mathematical expressions like this: - Pressure: $P = 1$ atm - Temperature: $T = 273.15$ K - Equations: $$ \\frac{P_1}{T_1} = \\frac{P_2}{T_2} $$""",
-    height=200
-)
-
-
-def ocr_with_gemini(image, prompt):
-    buf = BytesIO()
-    image.save(buf, format="JPEG")
-    encoded = base64.b64encode(buf.getvalue()).decode("utf-8")
-    
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    response = model.generate_content([
-        {"inline_data": {"mime_type": "image/jpeg", "data": encoded}},
-        prompt
-    ])
+
+GEMINI_MODEL = "models/gemini-2.0-flash"
+
+# Max in-flight Gemini requests and retry budget for rate-limit (429) errors
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "8"))
+OCR_MAX_RETRIES = 5
+
+# Rendered batches allowed to wait for OCR — caps memory regardless of corpus size
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+# Pages sent to Gemini per request, and the marker used to split the reply back into pages
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "4"))
+PAGE_MARKER_RE = re.compile(r"^\s*---PAGE (\d+)---\s*$", re.MULTILINE)
+END_MARKER_RE = re.compile(r"^\s*---END---\s*$", re.MULTILINE)
+CODE_FENCE_RE = re.compile(r"^\s*```[\w-]*[ \t]*\n(.*)\n[ \t]*```\s*$", re.DOTALL)
+FENCE_LINE_RE = re.compile(r"^[ \t]*```", re.MULTILINE)
+
+# Page render resolution sent to Gemini
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+
+# Pages with a smaller share of dark pixels are treated as blank and not OCR'd
+BLANK_PAGE_INK_RATIO = float(os.getenv("BLANK_PAGE_INK_RATIO", "0.0001"))
+
+# On-disk OCR cache: page text keyed by SHA-256 of the page image (+ prompt)
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", ".ocr_cache")
+
+# Per-chapter record of finished pages; left out of the download ZIP
+MANIFEST_NAME = ".manifest.json"
+
+# Old output is moved here before being deleted in the background. It sits next to
+# output/ (same filesystem, so the move is a rename) rather than inside it.
+TRASH_DIR = ".output_trash"
+
+
+def cache_path(jpeg_bytes, prompt):
+    # Prompt is part of the key since the sidebar can change what Gemini returns
+    key = hashlib.sha256(jpeg_bytes + prompt.encode("utf-8")).hexdigest()
+    return os.path.join(OCR_CACHE_DIR, key[:2], key)
+
+
+def read_cache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_caches(paths):
+    return [read_cache(path) if path else None for path in paths]
+
+
+def write_atomic(path, text):
+    # Write to a temp file and rename so a crashed run never leaves a partial file
+    # mkstemp gives each writer its own temp name — Streamlit sessions share one process
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_caches(entries):
+    for path, text in entries:
+        write_atomic(path, text)
+
+
+def make_gemini_client():
+    # A fresh client per asyncio.run(): its grpc_asyncio channel is bound to the event
+    # loop it was created on, and every Start OCR click (in any session) runs a new loop
+    return glm.GenerativeServiceAsyncClient(
+        client_options={"api_key": os.getenv("GEMINI_API_KEY")}  # or use a hardcoded key
+    )
+
+
+async def generate_with_retry(client, parts):
+    request = {"model": GEMINI_MODEL, "contents": [{"role": "user", "parts": parts}]}
+    for attempt in range(OCR_MAX_RETRIES):
+        try:
+            response = await client.generate_content(request=request)
+            return genai.types.GenerateContentResponse.from_response(response)
+        except ResourceExhausted:
+            # Rate limited — back off exponentially (1s, 2s, 4s, ...) and retry
+            if attempt == OCR_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+def image_part(jpeg_bytes):
+    return {"inline_data": {"mime_type": "image/jpeg", "data": jpeg_bytes}}
+
+
+async def ocr_with_gemini(client, jpeg_bytes, prompt, refresh=False):
+    # refresh=True ignores cached text (and overwrites it with the new answer).
+    # Cache file I/O goes through the default thread pool to keep the event loop free.
+    loop = asyncio.get_running_loop()
+    cached_path = cache_path(jpeg_bytes, prompt)
+    cached = None if refresh else await loop.run_in_executor(None, read_cache, cached_path)
+    if cached is not None:
+        return cached, 0
+
+    response = await generate_with_retry(client, [image_part(jpeg_bytes), {"text": prompt}])
     
     # Get the text and token count
-    text = getattr(response, "text", "⚠️ No OCR output")
     token_count = getattr(response.usage_metadata, "total_token_count", 0)
-    
+    try:
+        text = response.text
+    except ValueError:
+        # Blocked or RECITATION reply has no text — show a placeholder, don't cache it
+        return "⚠️ No OCR output", token_count
+
+    await loop.run_in_executor(None, write_atomic, cached_path, text)
     return text, token_count
 
 
-def pdf_to_images(pdf_path):
-    doc = fitz.open(pdf_path)
-    for page in doc:
-        pix = page.get_pixmap(dpi=300)
-        img = Image.open(BytesIO(pix.tobytes("png")))
-        yield img
-    doc.close()
+def batch_prompt(prompt, n_pages):
+    return (f"{prompt}\n\nYou are given {n_pages} images, one per page, in order. "
+            f"Start the text of each page with a line containing only ---PAGE N---, "
+            f"where N runs from 1 to {n_pages}. After the last page, write a line "
+            f"containing only ---END---.")
 
-def process_pdfs(input_dir, output_dir, progress_placeholder, status_placeholder):
-    total_tokens_used = 0
 
-    structure_output = []
-    pdfs = [os.path.join(root, file)
-            for root, _, files in os.walk(input_dir)
-            for file in files if file.lower().endswith(".pdf")]
-
-    for idx, pdf_file in enumerate(pdfs):
-        chapter_name = os.path.splitext(os.path.basename(pdf_file))[0]
-        chapter_out = os.path.join(output_dir, chapter_name)
-        os.makedirs(chapter_out, exist_ok=True)
-        structure_output.append(f"📂 {chapter_name}/")
+def split_pages(text, n_pages):
+    # Returns one text per page, or None if the markers don't line up with the batch.
+    # Pages end up in the permanent cache, so anything odd rejects the whole batch.
+    fenced = CODE_FENCE_RE.match(text)
+    if fenced:
+        text = fenced.group(1)
+    # Exactly one end marker with nothing after it — also catches truncated replies
+    body, *after_end = END_MARKER_RE.split(text)
+    if len(after_end) != 1 or after_end[0].strip():
+        return None
+    chunks = PAGE_MARKER_RE.split(body)[1:]
+    numbers, pages = chunks[0::2], chunks[1::2]
+    if numbers != [str(n) for n in range(1, n_pages + 1)]:
+        return None
+    # An unpaired ``` means a wrapper fence leaked into a page
+    if any(len(FENCE_LINE_RE.findall(page)) % 2 for page in pages):
+        return None
+    return [page.strip() for page in pages]
+
+
+async def ocr_batch_with_gemini(client, pages, prompt, refresh=False):
+    # OCR several pages in one request; blank and cached pages are skipped and a batch
+    # whose reply can't be split cleanly falls back to one request per page
+    loop = asyncio.get_running_loop()
+    paths = [None if jpeg_bytes is None else cache_path(jpeg_bytes, prompt) for jpeg_bytes in pages]
+    hits = [None] * len(pages) if refresh else await loop.run_in_executor(None, read_caches, paths)
+    results = [None] * len(pages)
+    misses = []
+    for i, (jpeg_bytes, cached) in enumerate(zip(pages, hits)):
+        if jpeg_bytes is None:
+            results[i] = ("", 0)
+        elif cached is not None:
+            results[i] = (cached, 0)
+        else:
+            misses.append(i)
+
+    if len(misses) == 1:
+        results[misses[0]] = await ocr_with_gemini(client, pages[misses[0]], prompt, refresh)
+    elif misses:
+        response = await generate_with_retry(
+            client, [image_part(pages[i]) for i in misses] + [{"text": batch_prompt(prompt, len(misses))}]
+        )
+        token_count = getattr(response.usage_metadata, "total_token_count", 0)
+        try:
+            texts = split_pages(response.text, len(misses))
+        except ValueError:
+            # Blocked or RECITATION reply — retry page by page like an unsplittable one
+            texts = None
+
+        if texts is None:
+            # One page at a time, so a worker never has more than one request in flight
+            fallback = [await ocr_with_gemini(client, pages[i], prompt, refresh) for i in misses]
+            texts = [text for text, _ in fallback]
+            token_count += sum(tokens for _, tokens in fallback)
+        else:
+            await loop.run_in_executor(None, write_caches, [(paths[i], text) for i, text in zip(misses, texts)])
+
+        # Tokens are billed per request, so the batch total is booked on its first page
+        for n, (i, text) in enumerate(zip(misses, texts)):
+            results[i] = (text, token_count if n == 0 else 0)
+
+    return results
+
+
+def write_pages(pages):
+    # Raw os.open/os.write skips the buffered text-file layers; no fsync since
+    # every page can be regenerated from the PDF
+    for path, text in pages:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            data = memoryview(text.encode("utf-8"))
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+
+def page_txt_name(chapter_name, page_no):
+    return f"{chapter_name}_page_{page_no}.txt"
+
 
-        images = list(pdf_to_images(pdf_file))
-        for i, img in enumerate(images):
-            status_placeholder.info(f"🔍 Processing: {chapter_name} (Page {i+1}/{len(images)})")
-            text, token_count = ocr_with_gemini(img, prompt=custom_prompt)
-            total_tokens_used += token_count
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-            txt_name = f"{chapter_name}_page_{i+1}.txt"
-            txt_path = os.path.join(chapter_out, txt_name)
-            with open(txt_path, "w", encoding="utf-8") as f:
-                f.write(text)
-            structure_output.append(f"   └─ 📄 {txt_name}")
 
-        progress_placeholder.progress((idx + 1) / len(pdfs))
+def read_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-    st.info(f"🔢 Total Gemini Tokens Used: {total_tokens_used}")
+
+def finished_pages(chapter_out, chapter_name, manifest_key):
+    # Pages recorded as done by an earlier run over the same PDF bytes and prompt.
+    # Blank pages are recorded too, so their empty files count as done.
+    manifest = read_manifest(os.path.join(chapter_out, MANIFEST_NAME))
+    if (not isinstance(manifest, dict) or manifest.get("key") != manifest_key
+            or not isinstance(manifest.get("done"), list)):
+        return None
+    return {i for i in manifest["done"]
+            if os.path.exists(os.path.join(chapter_out, page_txt_name(chapter_name, i + 1)))}
+
+
+async def render_batches(pdf_jobs, executor, queue):
+    # Producer: render a window of pages across the process pool, then queue them in
+    # OCR-sized batches. The bounded queue stalls rendering when OCR falls behind.
+    loop = asyncio.get_running_loop()
+    window = OCR_BATCH_SIZE * max(1, (os.cpu_count() or 1) // OCR_BATCH_SIZE)
+    for chapter_name, pdf_file, page_nums in pdf_jobs:
+        for start in range(0, len(page_nums), window):
+            window_nums = page_nums[start:start + window]
+            pages = await asyncio.gather(*(
+                loop.run_in_executor(executor, render_page, pdf_file, i, OCR_DPI, BLANK_PAGE_INK_RATIO)
+                for i in window_nums
+            ))
+            for offset in range(0, len(pages), OCR_BATCH_SIZE):
+                await queue.put((
+                    chapter_name,
+                    window_nums[offset:offset + OCR_BATCH_SIZE],
+                    pages[offset:offset + OCR_BATCH_SIZE],
+                ))
+
+    # One sentinel per OCR worker
+    for _ in range(OCR_CONCURRENCY):
+        await queue.put(None)
+
+
+async def ocr_worker(queue, client, prompt, output_dir, on_batch_done, refresh=False):
+    # Consumer: OCR one batch at a time and write its pages out as soon as they return.
+    # Each batch is written in one trip to the default thread pool so file I/O doesn't
+    # stall other workers' requests.
+    loop = asyncio.get_running_loop()
+    tokens_used = 0
+    while (item := await queue.get()) is not None:
+        chapter_name, page_nums, pages = item
+        results = await ocr_batch_with_gemini(client, pages, prompt, refresh)
+        tokens_used += sum(token_count for _, token_count in results)
+        await loop.run_in_executor(None, write_pages, [
+            (os.path.join(output_dir, chapter_name, page_txt_name(chapter_name, i + 1)), text)
+            for i, (text, _) in zip(page_nums, results)
+        ])
+        await on_batch_done(chapter_name, page_nums)
+    return tokens_used
+
+
+def iter_pdfs(directory):
+    # scandir reuses the dirent type, so no extra stat() per entry like os.walk
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_pdfs(entry.path)
+            elif entry.name.lower().endswith(".pdf"):
+                yield entry.path
+
+
+async def process_pdfs(input_dir, output_dir, progress_placeholder, status_placeholder, prompt, force=False):
+    loop = asyncio.get_running_loop()
+    pdfs = list(iter_pdfs(input_dir))
+
+    # forkserver, not fork: forking the multithreaded Streamlit server can hand
+    # children locked mutexes
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             mp_context=multiprocessing.get_context("forkserver")) as executor:
+        page_counts = await asyncio.gather(*(
+            loop.run_in_executor(executor, page_count, pdf_file) for pdf_file in pdfs
+        ))
+        pdf_hashes = await asyncio.gather(*(
+            loop.run_in_executor(None, file_sha256, pdf_file) for pdf_file in pdfs
+        ))
+
+        pdf_jobs = []
+        chapter_pages = {}
+        chapter_keys = {}
+        pages_done = {}
+        for pdf_file, n_pages, pdf_hash in zip(pdfs, page_counts, pdf_hashes):
+            chapter_name = os.path.splitext(os.path.basename(pdf_file))[0]
+            chapter_out = os.path.join(output_dir, chapter_name)
+            manifest_key = hashlib.sha256(f"{pdf_hash}\0{prompt}".encode("utf-8")).hexdigest()
+
+            # Pages left over from an earlier (e.g. interrupted) run are not sent again.
+            # Output from a different PDF or prompt is stale and cleared.
+            done = None if force else finished_pages(chapter_out, chapter_name, manifest_key)
+            if done is None:
+                rm_async(chapter_out)
+                done = set()
+            os.makedirs(chapter_out, exist_ok=True)
+
+            pdf_jobs.append((chapter_name, pdf_file, [i for i in range(n_pages) if i not in done]))
+            chapter_pages[chapter_name] = n_pages
+            chapter_keys[chapter_name] = manifest_key
+            pages_done[chapter_name] = done
+
+        # Chapters from an earlier upload that aren't in this one would end up in the ZIP
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and entry.name not in chapter_pages:
+                    rm_async(entry.path)
+
+        total_pages = sum(page_counts)
+        manifest_lock = asyncio.Lock()
+
+        async def on_batch_done(chapter_name, page_nums):
+            done = pages_done[chapter_name]
+            done.update(page_nums)
+            # Manifest is rewritten off the event loop; the lock keeps writes in order,
+            # and each one snapshots the set inside it so an older list never lands last
+            async with manifest_lock:
+                await loop.run_in_executor(
+                    None,
+                    write_atomic,
+                    os.path.join(output_dir, chapter_name, MANIFEST_NAME),
+                    json.dumps({"key": chapter_keys[chapter_name], "done": sorted(done)}),
+                )
+            status_placeholder.info(
+                f"🔍 Processing: {chapter_name} (Page {len(done)}/{chapter_pages[chapter_name]})"
+            )
+            progress_placeholder.progress(sum(map(len, pages_done.values())) / total_pages)
+
+        # PDF walk → render (process pool) → OCR (async workers) → write, with a bounded hand-off
+        queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        async with make_gemini_client() as client:
+            _, *worker_tokens = await asyncio.gather(
+                render_batches(pdf_jobs, executor, queue),
+                *(ocr_worker(queue, client, prompt, output_dir, on_batch_done, refresh=force)
+                  for _ in range(OCR_CONCURRENCY))
+            )
+
+    structure_output = []
+    for chapter_name, n_pages in chapter_pages.items():
+        structure_output.append(f"📂 {chapter_name}/")
+        for page_no in range(1, n_pages + 1):
+            structure_output.append(f"   └─ 📄 {page_txt_name(chapter_name, page_no)}")
+
+    st.info(f"🔢 Total Gemini Tokens Used: {sum(worker_tokens)}")
     return "\n".join(structure_output)
 
 def zip_folder(folder_path):
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+    # Build the archive on disk rather than in memory; level 1 is plenty for plain text
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
+    tmp.close()
+    with zipfile.ZipFile(tmp.name, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
         for root, _, files in os.walk(folder_path):
             for file in files:
+                if file == MANIFEST_NAME:
+                    continue
                 abs_path = os.path.join(root, file)
                 rel_path = os.path.relpath(abs_path, folder_path)
                 zipf.write(abs_path, rel_path)
-    zip_buffer.seek(0)
-    return zip_buffer
-
-# Streamlit UI
-st.title("PDF Processing Pipeline")
-
-uploaded_zip = st.file_uploader("Upload a ZIP of PDFs", type=["zip"])
-if uploaded_zip:
-    upload_name = os.path.splitext(uploaded_zip.name)[0]
-    extract_dir = os.path.join("output", upload_name)
-    zip_path = os.path.join("output", f"{upload_name}.zip")
-
-    # Cleanup if exists
-    for path in [extract_dir, zip_path]:
-        if os.path.exists(path):
-            shutil.rmtree(path, ignore_errors=True)
-
-    os.makedirs(extract_dir, exist_ok=True)
-
-    # Save and extract zip
-    with open(zip_path, "wb") as f:
-        f.write(uploaded_zip.getbuffer())
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(extract_dir)
-
-    st.success(f"✅ Uploaded and extracted: `{extract_dir}`")
-
-    if st.button("🔍 Start OCR"):
-        result_path = os.path.join("output", f"{upload_name}_ocr")
-        shutil.rmtree(result_path, ignore_errors=True)
-        os.makedirs(result_path)
-
-        progress_placeholder = st.progress(0)
-        status_placeholder = st.empty()
-
-        structure = process_pdfs(extract_dir, result_path, progress_placeholder, status_placeholder)
-        status_placeholder.success("✅ OCR Complete!")
-        st.text_area("📂 Output Structure", structure, height=300)
-
-        # AFTER the text_area and ZIP creation
-        zipped = zip_folder(result_path)
-
-        # ➕ Store trigger for download
-        if st.download_button("⬇️ Download ZIP", zipped, file_name=f"{upload_name}_ocr.zip", mime="application/zip"):
-            # Flag that download was clicked
-            st.session_state["cleanup_trigger"] = True
-            st.rerun()  # 🔁 Rerun to reach the cleanup block
-
-        # 🔁 Now on next render, cleanup will execute once
-        if st.session_state["cleanup_trigger"]:
-            try:
-                shutil.rmtree(result_path, ignore_errors=True)
-                shutil.rmtree(extract_dir, ignore_errors=True)
-                if os.path.exists(zip_path):
-                    os.remove(zip_path)
-                if os.path.exists("output") and not os.listdir("output"):
-                    shutil.rmtree("output")
-                st.success("🧹 All temporary output files cleaned up.")
-            except Exception as e:
-                st.warning(f"⚠️ Cleanup failed: {str(e)}")
-            finally:
-                st.session_state["cleanup_trigger"] = False  # reset after use
+    return tmp.name
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def rm_background(path):
+    threading.Thread(target=remove_path, args=(path,), daemon=True).start()
+
+
+def rm_async(path):
+    # Rename into TRASH_DIR first (cheap) so the path can be reused right away,
+    # then delete it on a daemon thread so the UI doesn't freeze
+    if not os.path.exists(path):
+        return
+    try:
+        os.makedirs(TRASH_DIR, exist_ok=True)
+        trash_path = os.path.join(TRASH_DIR, uuid.uuid4().hex)
+        os.rename(path, trash_path)
+    except OSError:
+        # Couldn't move it aside — delete in place, best effort
+        try:
+            remove_path(path)
+        except OSError:
+            pass
+        return
+    rm_background(trash_path)
+
+
+@st.cache_resource
+def sweep_trash():
+    # Once per server process: finish deletions a previous process didn't get to
+    if os.path.isdir(TRASH_DIR):
+        for entry in os.listdir(TRASH_DIR):
+            rm_background(os.path.join(TRASH_DIR, entry))
+
+# Streamlit runs this script as __main__; the guard keeps process-pool workers, which
+# re-import the main script under another name, from building the UI again
+if __name__ == "__main__":
+    sweep_trash()
+
+    # At the top — before any state use
+    if "cleanup_trigger" not in st.session_state:
+        st.session_state["cleanup_trigger"] = False
+
+    # Sidebar for custom system prompt
+    st.sidebar.header("System Prompt")
+    custom_prompt = st.sidebar.text_area(
+        "Override Default",
+        value="""Extract all readable text from this image. Return only plain text and formatting if necessary. EXCLUSIVELY use latex tags for both markdown and mathematical notations and equations For mathematical expressions: 
+        1. For inline equations, use single dollar signs: $ ... $ 2. For display equations, use double dollar signs: $$ ... $$ 
+        3. For units, use regular text, not \\text command: atm, K, Â°C 
+        4. For variables, use single letters without \\text: P, T, V 5. Format mathematical expressions like this: - Pressure: $P = 1$ atm - Temperature: $T = 273.15$ K - Equations: $$ \\frac{P_1}{T_1} = \\frac{P_2}{T_2} $$""",
+        height=200
+    )
+    force_ocr = st.sidebar.checkbox("Force re-OCR (ignore saved pages and the OCR cache)", value=False)
+
+    # Streamlit UI
+    st.title("PDF Processing Pipeline")
+
+    uploaded_zip = st.file_uploader("Upload a ZIP of PDFs", type=["zip"])
+    if uploaded_zip:
+        upload_name = os.path.splitext(uploaded_zip.name)[0]
+        extract_dir = os.path.join("output", upload_name)
+        zip_path = os.path.join("output", f"{upload_name}.zip")
+
+        # Cleanup if exists
+        for path in [extract_dir, zip_path]:
+            rm_async(path)
+
+        os.makedirs(extract_dir, exist_ok=True)
+
+        # Save and extract zip
+        with open(zip_path, "wb") as f:
+            f.write(uploaded_zip.getbuffer())
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            zip_ref.extractall(extract_dir)
+
+        st.success(f"✅ Uploaded and extracted: `{extract_dir}`")
+
+        if st.button("🔍 Start OCR"):
+            result_path = os.path.join("output", f"{upload_name}_ocr")
+            # Keep earlier output so finished pages are skipped, unless a full redo is forced
+            if force_ocr:
+                rm_async(result_path)
+            os.makedirs(result_path, exist_ok=True)
+
+            progress_placeholder = st.progress(0)
+            status_placeholder = st.empty()
+
+            structure = asyncio.run(process_pdfs(extract_dir, result_path, progress_placeholder, status_placeholder, custom_prompt, force=force_ocr))
+            status_placeholder.success("✅ OCR Complete!")
+            st.text_area("📂 Output Structure", structure, height=300)
+
+            # AFTER the text_area and ZIP creation
+            zipped_path = zip_folder(result_path)
+
+            # ➕ Store trigger for download
+            with open(zipped_path, "rb") as zipped:
+                downloaded = st.download_button("⬇️ Download ZIP", zipped, file_name=f"{upload_name}_ocr.zip", mime="application/zip")
+            # download_button has already read the bytes, so the temp archive can go now
+            os.remove(zipped_path)
+            if downloaded:
+                # Flag that download was clicked
+                st.session_state["cleanup_trigger"] = True
+                st.rerun()  # 🔁 Rerun to reach the cleanup block
+
+            # 🔁 Now on next render, cleanup will execute once
+            if st.session_state["cleanup_trigger"]:
+                try:
+                    rm_async(result_path)
+                    rm_async(extract_dir)
+                    rm_async(zip_path)
+                    if os.path.exists("output") and not os.listdir("output"):
+                        shutil.rmtree("output")
+                    st.success("🧹 All temporary output files cleaned up.")
+                except Exception as e:
+                    st.warning(f"⚠️ Cleanup failed: {str(e)}")
+                finally:
+                    st.session_state["cleanup_trigger"] = False  # reset after use
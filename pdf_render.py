@@ -0,0 +1,52 @@
+# Page rendering lives in its own module so ProcessPoolExecutor workers can
+# import it without re-running the Streamlit script.
+
+import fitz  # PyMuPDF
+import numpy as np
+
+# libjpeg-turbo (SIMD) encoder when PyTurboJPEG and its shared library are installed,
+# otherwise MuPDF's own JPEG writer
+try:
+    from turbojpeg import TJPF_GRAY, TJSAMP_GRAY, TurboJPEG
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+
+def page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def gray_pixels(pix):
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def ink_ratio(pixels):
+    # Share of dark pixels on a 4x-subsampled grid — enough to tell blank pages apart
+    return (pixels[::4, ::4] < 200).mean()
+
+
+def encode_jpeg(pix, pixels, quality=85):
+    if _tj is None:
+        return pix.tobytes("jpeg", jpg_quality=quality)
+    return _tj.encode(
+        np.ascontiguousarray(pixels)[:, :, np.newaxis],
+        quality=quality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY,
+    )
+
+
+def render_page(pdf_path, page_num, dpi=200, min_ink=0.0):
+    # Each worker opens its own document — fitz.Document can't cross processes.
+    # Grayscale at 200 dpi is plenty for text: Gemini resizes inputs anyway,
+    # and it cuts raster work and upload bytes vs. 300 dpi RGB.
+    with fitz.open(pdf_path) as doc:
+        zoom = dpi / 72
+        pix = doc.load_page(page_num).get_pixmap(
+            matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False
+        )
+        pixels = gray_pixels(pix)
+        # Blank pages, dividers etc. come back as None so they never reach Gemini
+        if ink_ratio(pixels) < min_ink:
+            return None
+        return encode_jpeg(pix, pixels)